@@ -12,41 +12,94 @@ KNinja (and Ninja's) build definitions form a labelled multigraph where:
 """
 
 import kninja.ninja.ninja_syntax
-from copy import deepcopy
+import atexit
 import glob as glob_module
 import os
+import re
 import sys
-import argparse
-from shutil import which
-from itertools import filterfalse
+import functools
+import io
+import operator
 
 glob = glob_module.glob
+
+# Directory containing KNinja itself
+_KNINJA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _fast_glob(pattern):
+    """ `glob.glob`, with a shortcut for the common `dir/*.ext` patterns used
+        for test suites: a single `scandir` of `dir` and a suffix check.
+    """
+    match = re.fullmatch(r'([^*?\[]+)/\*\.(\w+)', pattern)
+    if match is None:
+        return glob_module.glob(pattern)
+    root, suffix = match.group(1), '.' + match.group(2)
+    try:
+        with os.scandir(root) as entries:
+            # Like `glob`, `*` does not match hidden files
+            return [ os.path.join(root, entry.name) for entry in entries
+                     if entry.name.endswith(suffix) and not entry.name.startswith('.')
+                   ]
+    except OSError:
+        return []
 def readlines(file):
     """ Read lines from a file. Useful for lists of failing tests etc.
         Filters empty lines, and comments.
     """
 
-    def remove_comments(line): return line.split('#')[0]
-    def is_empty(line):        return line == ""
-
     with open(file) as f_in:
-        lines = f_in
-        lines = map(remove_comments, lines)
-        lines = filter(None, map(str.rstrip, lines))
-        lines = filterfalse(is_empty, lines)
-        lines = list(lines)
-    return lines
+        data = f_in.read()
+    lines = (line.split('#', 1)[0].rstrip() for line in data.splitlines())
+    return [line for line in lines if line]
 
-def filter_out(l1, l2):
-    """ remove l2 from l1. Does not preserve order """
-    return list(set(l1) - set(l2))
+def _unique(l):
+    """ l without duplicates, keeping the first occurrence of each element """
+    return list(dict.fromkeys(l))
 
+def _contents_differ(file, data):
+    """ Whether `file` is missing or does not contain exactly `data` (bytes).
+        Compares sizes first, so that a changed file usually need not be read.
+    """
+    try:
+        if os.stat(file).st_size != len(data): return True
+        with open(file, 'rb') as f_in:
+            return f_in.read() != data
+    except FileNotFoundError:
+        return True
+
+def filter_out(l1, l2):
+    """ remove l2 from l1. Preserves the order of l1 """
+    l2 = set(l2)
+    return [x for x in l1 if x not in l2]
+
+# The same source paths flow through several of the helpers below
+_cached_splitext = functools.lru_cache(maxsize=4096)(os.path.splitext)
+def _splitext(path):
+    if isinstance(path, Target): return path.splitext
+    return _cached_splitext(path)
 def basename_no_ext(path):
-    return os.path.splitext(os.path.basename(path))[0]
+    return os.path.basename(_splitext(path)[0])
 def get_extension(path):
-    return os.path.splitext(path)[1][1:]
+    return _splitext(path)[1][1:]
+# `abspath` calls `getcwd` each time; targets are routed through `is_subpath`
+# with the same few paths over and over, so cache it.
+_abspath = functools.lru_cache(maxsize=4096)(os.path.abspath)
+@functools.lru_cache(maxsize=None)
+def _relative_subpath_prefix(parent):
+    """ The prefix of normalized relative paths below the relative directory
+        `parent`, or None if `parent` is the current directory.
+    """
+    parent = os.path.normpath(parent)
+    return None if parent == os.curdir else parent + os.sep
 def is_subpath(path, parent):
-    return os.path.abspath(path).startswith(os.path.abspath(parent) + os.sep)
+    # Relative paths are relative to the same cwd, so comparing their
+    # normalized forms is enough (and needs no syscalls).
+    if not os.path.isabs(path) and not os.path.isabs(parent):
+        prefix = _relative_subpath_prefix(parent)
+        if prefix is not None:
+            return os.path.normpath(path).startswith(prefix)
+    return _abspath(path).startswith(_abspath(parent) + os.sep)
+@functools.lru_cache(maxsize=4096)
 def place_in_dir(path, dir):
     # TODO: This is very simplistic, assumes that all paths are relative to topdir,
     # or are prefixed with builddir
@@ -55,26 +108,48 @@ def place_in_dir(path, dir):
         path = os.path.join(dir, path)
     return path
 def replace_extension(path, new_extension):
-    return os.path.splitext(path)[0] + '.' + new_extension
+    return _splitext(path)[0] + '.' + new_extension
 def append_extension(path, extension):
-    return path + '.' + extension
+    return str(path) + '.' + extension
+def _join(root, *paths):
+    """ `os.path.join`, with a cheaper path for the common case of non-empty
+        relative components joined onto a non-empty root. Empty or absolute
+        components, and components other than the last ending in '/', are
+        left to `os.path.join`.
+    """
+    if not paths: return root
+    if not root: return os.path.join(root, *paths)
+    for path in paths:
+        if not path or path[0] == '/': return os.path.join(root, *paths)
+    for path in paths[:-1]:
+        if path[-1] == '/': return os.path.join(root, *paths)
+    if root.endswith('/'): return root + '/'.join(paths)
+    return root + '/' + '/'.join(paths)
 
 class Target():
     def __init__(self, proj, path):
         self.proj = proj
         self.path = path
         self._alias = None
+        self._split = None
 
     def __str__(self):
         return self.path
 
+    @property
+    def splitext(self):
+        """ `os.path.splitext` of the path, computed once per target. """
+        if self._split is None:
+            self._split = _cached_splitext(self.path)
+        return self._split
+
     def then(self, rule):
         target = rule.get_build_edge_target_path(self)
         return rule.build_edge(self.proj, self, target)
 
     def alias(self, alias):
         self._alias = alias
-        self.proj.build(alias, 'phony', self.path)
+        self.proj.alias(alias, self)
         return self
 
     def default(self):
@@ -83,18 +158,39 @@ class Target():
 
     @staticmethod
     def to_paths(value):
-        if value is None:
-            return []
-        if isinstance(value, list):
-            ret = []
-            for v in value:
-                ret += Target.to_paths(v)
-            return ret
-        if isinstance(value, str):
-            return [value]
-        if isinstance(value, Target):
-            return [value.path]
-        assert False, type(value)
+        # Fast paths for the common cases: a single path or target, or a flat
+        # list of them, dispatched on the exact type.
+        to_path = _TO_PATH.get(type(value))
+        if to_path is not None:
+            return [to_path(value)]
+        if type(value) is list:
+            try:
+                return [_TO_PATH[type(v)](v) for v in value]
+            except KeyError:
+                pass # Nested lists, `None`s or subclasses: handled below
+
+        # Flattens arbitrarily nested lists iteratively, rather than
+        # concatenating the results of recursive calls.
+        ret = []
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if value is None:
+                continue
+            if isinstance(value, str):
+                ret.append(value)
+            elif isinstance(value, Target):
+                ret.append(value.path)
+            elif isinstance(value, list):
+                stack.extend(reversed(value))
+            else:
+                assert False, type(value)
+        return ret
+
+# How `Target.to_paths` converts each kind of (non-list) value to a path
+_TO_PATH = { str    : str.__str__
+           , Target : operator.attrgetter('path')
+           }
 
 class KDefinition():
     def __init__( self
@@ -122,6 +218,19 @@ class KDefinition():
         self._runner_script = runner_script
         self._target = target
 
+        # Names of the per-definition runner-script rules and their output
+        # extensions, keyed by mode.
+        self._runner_rule_names = { mode: sys.intern('runner-script-' + alias + '-' + mode) for mode in ('run', 'prove') }
+        self._runner_exts       = { mode: sys.intern(alias + '-' + mode)                    for mode in ('run', 'prove') }
+        self._runner_descriptions = { mode: mode + ': ' + alias + ' $in' for mode in ('run', 'prove') }
+        self._runner_cache = {}
+
+        # The krun, kast and kprove rules, with this definition's directory
+        # and target filled in. Built on first use.
+        self._rule_krun   = None
+        self._rule_kast   = None
+        self._rule_kprove = None
+
     @property
     def proj(self):
         return self._proj
@@ -133,44 +242,51 @@ class KDefinition():
     """ High Level Interface """
 
     def directory(self, *path):
-        return os.path.join(self._directory, *path)
+        return _join(self._directory, *path)
 
     def kompiled_dir(self, *path):
-        return os.path.join(self._kompiled_dir, *path)
+        return _join(self._kompiled_dir, *path)
 
     def tests(self, expected = None, inputs = None, implicit_inputs = None, glob = None, alias = None, default = True, flags = ''):
-        if inputs is None:
-            inputs = []
+        # Copy, so that the caller's list is not extended with the glob
+        inputs = [] if inputs is None else list(inputs)
         if implicit_inputs is None:
             implicit_inputs = []
         if glob is not None:
-            inputs += glob_module.glob(glob)
-        ret = []
-        for input in inputs:
-            e = expected
-            if e is None:
-                e = append_extension(input, 'expected')
-            input = self.proj.to_target(input)
-            test = input.then(self.runner_script(mode = 'run', flags = flags).implicit(implicit_inputs)) \
-                        .then(self.proj.check(expected = e))
-            if default: test.default()
-            ret += [test]
+            inputs += self.proj._glob(glob)
+        ret = [None] * len(inputs)
+        if inputs:
+            # The rules are the same for every input (unless each has its own
+            # expected output), so build them once. Empty suites need none.
+            runner = self.runner_script(mode = 'run', flags = flags).implicit(implicit_inputs)
+            check = None if expected is None else self.proj.check(expected = expected)
+            for i, input in enumerate(inputs):
+                input_check = check
+                if input_check is None:
+                    input_check = self.proj.check(expected = append_extension(input, 'expected'))
+                input = self.proj.to_target(input)
+                test = input.then(runner).then(input_check)
+                if default: test.default()
+                ret[i] = test
         if alias is not None:
             ret = self.proj.alias(alias, ret)
         return ret
 
-    def proofs(self, inputs = [], glob = None, alias = None, default = True, expected = None, flags = ''):
+    def proofs(self, inputs = None, glob = None, alias = None, default = True, expected = None, flags = ''):
         if expected is None:
            expected = self.proj.kninjadir('kprove.expected')
+        inputs = [] if inputs is None else list(inputs)
         if glob is not None:
-            inputs += glob_module.glob(glob)
-        ret = []
-        for input in inputs:
-            input = self.proj.to_target(input)
-            test = input.then(self.runner_script(mode = 'prove', flags = flags)) \
-                        .then(self.proj.check(expected))
-            if default: test.default()
-            ret += [test]
+            inputs += self.proj._glob(glob)
+        ret = [None] * len(inputs)
+        if inputs:
+            runner = self.runner_script(mode = 'prove', flags = flags)
+            check = self.proj.check(expected)
+            for i, input in enumerate(inputs):
+                input = self.proj.to_target(input)
+                test = input.then(runner).then(check)
+                if default: test.default()
+                ret[i] = test
         if alias is not None:
             ret = self.proj.alias(alias, ret)
         return ret
@@ -179,50 +295,69 @@ class KDefinition():
 
     # mode: run|prove
     def runner_script(self, mode, flags = ''):
-        # TODO: We use a different rule for each kompiled definition, since
-        # the `ext` flag is tied to the rule instead of the build edge
-        return self.proj.rule( 'runner-script-' + self._alias + '-' + mode
-                             , description = mode + ': ' + self._alias + ' $in'
-                             , command = self._runner_script + ' ' + mode + ' --definition "$definition" "$in" $flags > "$out" || (cat $out ; false)'
-                             , ext = self._alias + '-' + mode
-                             ) \
-                             .variable('definition', self._alias) \
-                             .implicit([self.target]) \
-                             .variable('flags', flags)
+        # Rules are immutable, so the same one can be shared by every test
+        # using this mode and flags.
+        key = (mode, flags)
+        if key not in self._runner_cache:
+            if self._runner_script is None:
+                raise ValueError('Definition "%s" has no runner script' % (self._alias))
+            # TODO: We use a different rule for each kompiled definition, since
+            # the `ext` flag is tied to the rule instead of the build edge
+            self._runner_cache[key] = \
+                self.proj.rule( self._runner_rule_names[mode]
+                              , description = self._runner_descriptions[mode]
+                              , command = _RUNNER_SCRIPT_COMMAND % (self._runner_script, mode)
+                              , ext = self._runner_exts[mode]
+                              ) \
+                              .variable('definition', self._alias) \
+                              .implicit([self.target]) \
+                              .variable('flags', flags)
+        return self._runner_cache[key]
 
     def krun(self, krun_flags = '', extension = None, runner = None):
-        return self.proj.rule( 'krun'
-                             , description = 'krun: $in ($directory)'
-                             , command = '$env "krun" $flags --directory $directory $in > $out || (cat $out ; false)'
-                             , ext = self._krun_extension
-                             ) \
-                             .variable('directory', self.directory()) \
-                             .variable('flags', self._krun_flags + ' ' + krun_flags) \
-                             .variable('env', self._krun_env) \
-                             .implicit([self.target])
+        if self._rule_krun is None:
+            self._rule_krun = self.proj.rule( 'krun'
+                                            , description = 'krun: $in ($directory)'
+                                            , command = _KRUN_COMMAND
+                                            , ext = self._krun_extension
+                                            ) \
+                                            .variables( directory = self.directory()
+                                                      , flags = self._krun_flags
+                                                      , env = self._krun_env
+                                                      ) \
+                                            .implicit([self.target])
+        return self._rule_krun.variable('flags', self._krun_flags + ' ' + krun_flags)
 
     def kast(self):
-        return self.proj.rule( 'kast'
-                             , description = 'kast: $in ($directory)'
-                             , command     = '$env "kast" $flags --directory "$directory" "$in" > "$out" || (cat $out ; false)'
-                             , ext = 'kast'
-                             ) \
-                             .variables(directory = self.directory()) \
-                             .implicit([self.target])
+        if self._rule_kast is None:
+            self._rule_kast = self.proj.rule( 'kast'
+                                            , description = 'kast: $in ($directory)'
+                                            , command     = _KAST_COMMAND
+                                            , ext = 'kast'
+                                            ) \
+                                            .variables(directory = self.directory()) \
+                                            .implicit([self.target])
+        return self._rule_kast
 
     def kprove(self):
         # kprove prints errors to stdout, instead of stderror
         # The kprove rule `cat`s its output after failing for convenience.
         # I'm not sure if there is a better way.
-        return self.proj.rule( 'kprove'
-                             , description = 'kprove: $in ($directory)'
-                             , command     = '$env "kprove" $flags --directory "$directory" "$in" > "$out" || (cat "$out"; false)'
-                             , ext = self._kprove_extension
-                             ) \
-                             .variables(directory = self.directory()) \
-                             .implicit([self.target])
+        if self._rule_kprove is None:
+            self._rule_kprove = self.proj.rule( 'kprove'
+                                              , description = 'kprove: $in ($directory)'
+                                              , command     = _KPROVE_COMMAND
+                                              , ext = self._kprove_extension
+                                              ) \
+                                              .variables(directory = self.directory()) \
+                                              .implicit([self.target])
+        return self._rule_kprove
 
 class Rule():
+    __slots__ = ( 'name', 'description', 'command'
+                , '_ext', '_output', '_implicit', '_implicit_outputs', '_pool', '_variables'
+                )
+
     def __init__(self, name, description, command, ext = None):
         self.name = name
         self.description = description
@@ -234,61 +369,140 @@ class Rule():
         self._pool             = None
         self._variables        = {}
 
-    def ext(self, ext)                          : r = deepcopy(self); r._ext               = ext              ; return r
-    def output(self, output)                    : r = deepcopy(self); r._output            = output           ; return r
-    def implicit(self, implicit)                : r = deepcopy(self); r._implicit += Target.to_paths(implicit); return r
-    def implicit_outputs(self, implicit_outputs): r = deepcopy(self); r._implicit_outputs += implicit_outputs ; return r
-    def pool(self, pool)                        : r = deepcopy(self); r._pool              = pool             ; return r
-    def variables(self, **variables):
-        r = deepcopy(self)
-        # Merge the two dictionaries
-        r._variables = { **self._variables, **variables }
+    def _replace(self, **changes):
+        """ A copy of this rule, with the given slots replaced. Rules are never
+            mutated once built, so the copy may share the other slots' values.
+        """
+        r = Rule.__new__(Rule)
+        for slot in Rule.__slots__:
+            setattr(r, slot, changes[slot] if slot in changes else getattr(self, slot))
         return r
+
+    def ext(self, ext)                          : return self._replace(_ext = ext)
+    def output(self, output)                    : return self._replace(_output = output)
+    def implicit(self, implicit)                : return self._replace(_implicit = _unique(self._implicit + Target.to_paths(implicit)))
+    def implicit_outputs(self, implicit_outputs): return self._replace(_implicit_outputs = self._implicit_outputs + list(implicit_outputs))
+    def pool(self, pool)                        : return self._replace(_pool = pool)
+    def variables(self, **variables):
+        # Merge the two dictionaries. `variables` is a fresh dict, so it can
+        # be used as is when there is nothing to merge.
+        return self._replace(_variables = { **self._variables, **variables } if self._variables else variables)
     def variable(self, name, value):
-        r = deepcopy(self)
-        r._variables[name] = value
-        return r
+        return self._replace(_variables = { **self._variables, name: value })
 
     def get_build_edge_target_path(self, source):
         if self._output: return self._output
         if self._ext:
-            path = source.proj.place_in_output_dir(source.path + '.' + self._ext)
+            path = source.proj.place_in_output_dir(append_extension(source, self._ext))
             return path
         raise ValueError("Dont know how to generate target path for rule '%s'" % (self.name))
 
     def build_edge(self, proj, source, target):
-        proj.build( rule = self.name
-                  , inputs = source.path, outputs = target, implicit = Target.to_paths(self._implicit)
-                  , implicit_outputs = self._implicit_outputs, pool = self._pool, variables = self._variables
-                  )
+        # Most edges have no implicit outputs, pool etc. Only pass what is set.
+        # (`_implicit` already holds paths; see `implicit`.)
+        kwargs = {}
+        if self._implicit:         kwargs['implicit']         = self._implicit
+        if self._implicit_outputs: kwargs['implicit_outputs'] = self._implicit_outputs
+        if self._pool is not None: kwargs['pool']             = self._pool
+        if self._variables:        kwargs['variables']        = self._variables
+        proj.build(rule = self.name, inputs = source.path, outputs = target, **kwargs)
         return Target(proj, target)
 
+_RULE_TEMPLATE             = 'rule {name}\n  command = {command}\n'
+_RULE_DESCRIPTION_TEMPLATE = '  description = {description}\n'
+
+# Commands of the rules KNinja defines. Ninja expands the `$` variables.
+_CLEAN_COMMAND              = 'ninja -t clean ; rm -rf "$builddir" ; git submodule update --init --recursive'
+_GIT_SUBMODULE_INIT_COMMAND = 'git -c submodule.fetchJobs=0 submodule update $flags $jobs --init "$path" && touch "$out"'
+_BUILD_K_COMMAND            = '(  cd $k_repository && mvn package -DskipTests $flags)&& touch $out'
+_KOMPILE_COMMAND            = '$env "kompile" --backend "$backend" $flags --directory "$directory" $in'
+_CHECK_COMMAND              = 'git diff --color=always --no-index $flags "$expected" "$in"'
+_RUNNER_SCRIPT_COMMAND      = '%s %s --definition "$definition" "$in" $flags > "$out" || (cat $out ; false)' # runner script, mode
+_KRUN_COMMAND               = '$env "krun" $flags --directory $directory $in > $out || (cat $out ; false)'
+_KAST_COMMAND               = '$env "kast" $flags --directory "$directory" "$in" > "$out" || (cat $out ; false)'
+_KPROVE_COMMAND             = '$env "kprove" $flags --directory "$directory" "$in" > "$out" || (cat "$out"; false)'
+
+def _memoized_target(method):
+    """ Memoize a KProject method that adds build edges, so that the edges are
+        only added once per project (and argument values).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        key = (method.__name__,) + args
+        target = self._memoized_targets.get(key)
+        if target is None:
+            target = self._memoized_targets[key] = method(self, *args)
+        return target
+    return wrapper
+
+def _memoized_path(method):
+    """ Memoize a KProject directory accessor. The cache lives on the project,
+        so that it goes away with it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *paths):
+        key = (method.__name__,) + paths
+        path = self._memoized_paths.get(key)
+        if path is None:
+            path = self._memoized_paths[key] = method(self, *paths)
+        return path
+    return wrapper
+
 # KProject
 # ========
 #
 # A KProject manages a single `ninja` build file.
 
 class KProject(ninja.ninja_syntax.Writer):
+    # The file in the kompiled directory that `kompile` produces for each
+    # backend, and the Maven flags for building only the parts of K needed by
+    # it. Subclasses may extend these to support other backends.
+    _BACKEND_OUTPUT = { 'llvm'    : ('interpreter',)
+                      , 'java'    : ('timestamp',)
+                      , 'haskell' : ('definition.kore',)
+                      }
+    _BACKEND_FLAGS = { 'java'    : '-Dllvm.backend.skip -Dhaskell.backend.skip'
+                     , 'haskell' : '-Dllvm.backend.skip'
+                     , 'llvm'    : '-Dhaskell.backend.skip -Dproject.build.type=RelWithDebInfo'
+                     }
+
     def __init__(self, use_system_k = ('KNINJA_USE_SYSTEM_K' in os.environ), extdir = 'ext'):
-        self.written_rules = {}
-        self._backend_targets =  dict(java=None, haskell=None, llvm=None)
-        self._k_repo_init = None
+        # Maps the name of each rule written so far to its (description, command)
+        self._written_rules = {}
+        # Targets built by `_memoized_target` methods
+        self._memoized_targets = {}
+        # Results of the `_memoized_path` directory accessors
+        self._memoized_paths = {}
+        # The `check` rule for each expected-output file
+        self._check_rules = {}
         self._extdir = extdir
+        self._glob_cache = {}
+        # Aliases and defaults are collected and written out by `close`,
+        # so that each alias is emitted as a single phony build edge.
+        self._pending_aliases = {}
+        self._pending_defaults = []
 
         self.use_system_k = use_system_k
         if use_system_k:
+            from shutil import which # Only needed here; shutil is slow to import
             kompile = which('kompile')
             if not kompile: raise RuntimeError('"kompile" not found in PATH')
             self._k_release_dir = os.path.dirname(os.path.dirname(kompile))
         else:
             self._k_release_dir = self.krepodir('k-distribution/target/release/k/')
-            os.environ['PATH'] = self.kbindir() + ':' + os.environ['PATH']
+            # Only prepend once, even if several projects are constructed
+            if self.kbindir() not in os.environ['PATH'].split(os.pathsep):
+                os.environ['PATH'] = self.kbindir() + os.pathsep + os.environ['PATH']
         print('use_system_k', self.use_system_k)
         print('k', self.kbindir('k'))
 
-        if not os.path.exists(self.builddir()):
-            os.mkdir(self.builddir())
-        super().__init__(open(self.builddir('generated.ninja'), 'w'))
+        os.makedirs(self.builddir(), exist_ok = True)
+        self._builddir_prefix = self.builddir('')
+        # The generator emits many small fragments; collect them in memory, and
+        # write the file in one go when closing.
+        super().__init__(io.StringIO())
+        # Scripts that never call `main` still get their build file written
+        atexit.register(self.close)
 
         # Always define at least one default target. Otherwise, all targets are run (including clean)
         self.alias('dummy', []).default()
@@ -299,14 +513,13 @@ class KProject(ninja.ninja_syntax.Writer):
 
     def main(self, argv = sys.argv[1:]):
         self.close()
-        parser = argparse.ArgumentParser()
-        namespace, remaining = parser.parse_known_args(argv)
-        os.execlp('ninja', 'ninja', '-f', self.builddir('generated.ninja'), *remaining)
+        # All arguments are passed through to ninja, so there is nothing to parse
+        os.execvp('ninja', ['ninja', '-f', self.builddir('generated.ninja'), *argv])
 
     def to_target(self, input):
         if type(input) is Target: return input
         if type(input) is str:    return self.source(input)
-        assert(false)
+        raise TypeError('Expected a Target or a path, got %r' % (input,))
 
     def suite(self, name, inputs, runner, default = True):
         tests = []
@@ -328,35 +541,27 @@ class KProject(ninja.ninja_syntax.Writer):
         if directory is None:
             directory = self.builddir('defn', alias)
 
-        def target_from_source(source):
-            source = self.to_target(source)
-            assert(type(source) == Target)
-            return source
-        main = target_from_source(main)
-        other = list(map(target_from_source, other))
+        main = self.to_target(main)
+        # Sources and targets in `other` are only needed as paths
+        other = Target.to_paths(other)
 
-        kompiled_dir =  os.path.join(directory, basename_no_ext(main.path) + '-kompiled')
-        output = None
+        kompiled_dir =  os.path.join(directory, basename_no_ext(main) + '-kompiled')
+        if backend not in self._BACKEND_OUTPUT:
+            raise ValueError('Unknown backend "%s"' % (backend))
+        output = os.path.join(kompiled_dir, *self._BACKEND_OUTPUT[backend])
         env = ''
-        implicit_inputs = []
-        if not self.use_system_k: implicit_inputs += [self.build_k(backend)]
-        if backend == 'llvm':
-            output = os.path.join(kompiled_dir, 'interpreter')
-        elif backend == 'java':
-            output = os.path.join(kompiled_dir, 'timestamp')
-        elif backend == 'haskell':
-            output = os.path.join(kompiled_dir, 'definition.kore')
-        else:
-            assert false, 'Unknown backend "' + backend + "'"
+        k_target = None
+        if not self.use_system_k: k_target = self.build_k(backend)
 
         target = main.then(self.rule_kompile()                    \
                                .output(output)                    \
                                .implicit(other)                   \
-                               .implicit(implicit_inputs) \
-                               .variable('backend', backend)      \
-                               .variable('directory', directory)  \
-                               .variable('env', env)              \
-                               .variable('flags', '-I ' + directory + ' ' + flags)  \
+                               .implicit(k_target)                \
+                               .variables( backend   = backend
+                                         , directory = directory
+                                         , env       = env
+                                         , flags     = '-I ' + directory + ' ' + flags
+                                         )
                           ).alias(alias)
         return KDefinition( self, alias, directory, kompiled_dir, target
                           , runner_script = runner_script
@@ -365,55 +570,90 @@ class KProject(ninja.ninja_syntax.Writer):
                           , backend = backend
                           )
 
+    def _glob(self, pattern):
+        # The same pattern is often used for several definitions/backends;
+        # walk the filesystem only once per pattern.
+        if pattern not in self._glob_cache:
+            self._glob_cache[pattern] = _fast_glob(pattern)
+        return list(self._glob_cache[pattern])
+
     def alias(self, name, targets):
-        self.build(name, 'phony', Target.to_paths(targets))
+        self._pending_aliases.setdefault(name, []).extend(Target.to_paths(targets))
         return Target(self, name)
 
     def default(self, targets):
-        super().default(Target.to_paths(targets))
+        self._pending_defaults += Target.to_paths(targets)
+
+    def close(self):
+        if self.output.closed: return
+        for name, targets in self._pending_aliases.items():
+            self.build(name, 'phony', targets)
+        # Ninja only accepts defaults for targets that have already been declared
+        super().default(self._pending_defaults)
+
+        # Leave the file (and its mtime) alone if nothing changed. Otherwise,
+        # write to a temporary file and rename it, so that ninja never sees a
+        # partially written build file.
+        path = self.builddir('generated.ninja')
+        contents = self.output.getvalue().encode()
+        if _contents_differ(path, contents):
+            with open(path + '.tmp', 'wb') as f_out:
+                f_out.write(contents)
+            os.replace(path + '.tmp', path)
+        super().close()
 
 # Directory Layout
 # ================
 #
 # Users may subclass KProjects, and override these methods for alternate project
-# layouts.
+# layouts. They are called for nearly every rule and target, so their results are
+# cached.
 
 # Dependency Paths
 # ----------------
 
 # Directory for storing submodules used by KNinja
+    @_memoized_path
     def extdir(self, *paths):
-        return os.path.join(self._extdir, *paths)
+        return _join(self._extdir, *paths)
 
 # Path to the K Framework
+    @_memoized_path
     def krepodir(self, *paths):
         return self.extdir('k', *paths)
 
 # K release dir
+    @_memoized_path
     def kreleasedir(self, *paths):
-        return os.path.join(self._k_release_dir, *paths)
+        return _join(self._k_release_dir, *paths)
 
 # Directory where K binaries are stored
+    @_memoized_path
     def kbindir(self, *paths):
         return self.kreleasedir("bin", *paths)
 
+    @_memoized_path
     def klibdir(self, *paths):
         return self.kreleasedir("lib/kframework", *paths)
 
 # Path to the KNinja project
+    @_memoized_path
     def kninjadir(self, *paths):
-        return os.path.join(os.path.dirname(__file__), *paths)
+        return _join(_KNINJA_DIR, *paths)
 
 # Build Paths
 # -----------
 
 # The project's main build directory
+    @_memoized_path
     def builddir(self, *paths):
-        return os.path.join('.build', *paths)
+        return _join('.build', *paths)
 
 # If a (relative) output path is not in the buiddir, place it there. Otherwise
 # return the same path unchanged.
     def place_in_output_dir(self, path):
+        # Paths produced by earlier rules already start with the builddir
+        if path.startswith(self._builddir_prefix): return path
         return place_in_dir(path, self.builddir(''))
 
 # Generating the Ninja build script
@@ -422,22 +662,51 @@ class KProject(ninja.ninja_syntax.Writer):
     def generate_ninja(self):
         self.comment('This is a generated file')
         self.newline()
-        self.variable('ninja_required_version', '1.7')
-        self.variable('builddir', self.builddir())
-        # TODO: Remove underscores for consistancy
-        self.variable('k_repository', self.krepodir())
+        self.variables_bulk({ 'ninja_required_version' : '1.7'
+                            , 'builddir'               : self.builddir()
+                            # TODO: Remove underscores for consistancy
+                            , 'k_repository'           : self.krepodir()
+                            })
         self.rule('clean'
                  , description = 'cleaning'
-                 , command = 'ninja -t clean ; rm -rf "$builddir" ; git submodule update --init --recursive'
+                 , command = _CLEAN_COMMAND
                  )
         self.build('clean', 'clean')
 
+        # Rules used by (nearly) every project are registered once, up front
+        self._kompile_rule = self.rule( 'kompile'
+                                      , description = 'kompile: $directory $in'
+                                      , command     = _KOMPILE_COMMAND
+                                      )
+        self._check_rule = self.rule( 'check-test-result'
+                                    , description = 'diff: $in'
+                                    , command = _CHECK_COMMAND
+                                    , ext = 'test'
+                                    )
+
+    def variables_bulk(self, variables):
+        """ Write several top-level variables with a single write """
+        self.output.write(''.join('%s = %s\n' % (key, value) for key, value in variables.items()))
+
     def rule(self, name, description, command, ext = None):
-        rule = Rule(name, description, command, ext)
-        if not(name in self.written_rules):
-            super().rule(name, description = description, command = command)
-            self.written_rules[name] = rule
-        return rule
+        signature = (description, command)
+        written = self._written_rules.get(name)
+        if written is not None and written != signature:
+            # A different rule was already written under this name. Rather than
+            # silently reusing that one, name this one after its contents.
+            import hashlib # Only needed here; not worth importing up front
+            digest = hashlib.blake2b(repr(signature).encode(), digest_size = 3).hexdigest()
+            name = name + '-' + digest
+            written = self._written_rules.get(name)
+        if written is None:
+            # KProject rules only ever set a command and description, so
+            # write them directly instead of going through `Writer.rule`.
+            text = _RULE_TEMPLATE.format(name = name, command = command)
+            if description:
+                text += _RULE_DESCRIPTION_TEMPLATE.format(description = description)
+            self.output.write(text)
+            self._written_rules[name] = signature
+        return Rule(name, description, command, ext)
 
     def source(self, path):
         assert(type(path) == str)
@@ -450,37 +719,33 @@ class KProject(ninja.ninja_syntax.Writer):
     def dotTarget(self):
         return Target(self, '')
 
-    def rule_git_submodule_init(self, path, timestamp_file):
-        return self.rule( 'git-submodule-init',
+    # Submodules are fetched in parallel (`submodule.fetchJobs=0` lets git
+    # pick a reasonable number of jobs). `jobs` overrides that number.
+    def rule_git_submodule_init(self, path, timestamp_file, jobs = None):
+        rule = self.rule( 'git-submodule-init',
                           description = None,
-                          command     = 'git submodule update $flags --init "$path" && touch "$out"'
+                          command     = _GIT_SUBMODULE_INIT_COMMAND
                         ) \
                    .output(timestamp_file) \
                    .variable('path', path)
+        if jobs is not None: rule = rule.variable('jobs', '--jobs ' + str(jobs))
+        return rule
 
+    @_memoized_target
     def init_k_submodule(self):
-        if self._k_repo_init is None:
-            self._k_repo_init = self.dotTarget().then(
-                    self.rule_git_submodule_init( path = self.extdir('k')
-                                                , timestamp_file = self.builddir('k.init')
-                                                ).variable('flags', '--recursive'))
-        return self._k_repo_init
+        # Refer to the top-level ninja variables rather than repeating
+        # the paths.
+        return self.dotTarget().then(
+                self.rule_git_submodule_init( path = '$k_repository'
+                                            , timestamp_file = '$builddir/k.init'
+                                            ).variable('flags', '--recursive'))
 
     def rule_build_k(self, backend):
-        flags = ''
+        flags = self._BACKEND_FLAGS[backend]
         implicit = [self.init_k_submodule()]
-        if backend == 'java':
-            flags = '-Dllvm.backend.skip -Dhaskell.backend.skip'
-        if backend == 'haskell':
-            flags = '-Dllvm.backend.skip'
-        if backend == 'llvm':
-            flags = '-Dhaskell.backend.skip -Dproject.build.type=RelWithDebInfo'
         return self.rule( 'build-k'
                         , description = 'build K: $backend'
-                        , command =    '(  cd $k_repository ' +
-                                       '&& mvn package -DskipTests $flags' +
-                                       ')' +
-                                    '&& touch $out'
+                        , command = _BUILD_K_COMMAND
                         ) \
                    .output('$builddir/kbackend-' + backend) \
                    .pool('console') \
@@ -488,22 +753,18 @@ class KProject(ninja.ninja_syntax.Writer):
                    .variable('flags', flags) \
                    .variable('backend', backend)
 
+    @_memoized_target
     def build_k(self, backend):
-        if not(self._backend_targets[backend]):
-            self._backend_targets[backend] = self.dotTarget().then(self.rule_build_k(backend))
-        return self._backend_targets[backend]
+        return self.dotTarget().then(self.rule_build_k(backend))
 
     def rule_kompile(self):
-        return  self.rule( 'kompile'
-                         , description = 'kompile: $directory $in'
-                         , command     = '$env "kompile" --backend "$backend" $flags '
-                                       + '--directory "$directory" $in'
-                         )
+        return self._kompile_rule
 
     def check(self, expected):
-        return self.rule( 'check-test-result'
-                        , description = 'diff: $in'
-                        , command = 'git diff --color=always --no-index $flags "$expected" "$in"'
-                        , ext = 'test') \
-                   .variable('expected', expected) \
-                   .implicit([expected])
+        # Rules are immutable, so the same one may be handed out repeatedly
+        rule = self._check_rules.get(expected)
+        if rule is None:
+            rule = self._check_rules[expected] = self._check_rule \
+                                                     .variable('expected', expected) \
+                                                     .implicit([expected])
+        return rule
@@ -1,9 +1,10 @@
 import argparse
-import functools
 import os
 import sys
 from collections import OrderedDict
 
+from kninja import _KNINJA_DIR, _join
+
 class KProject():
     ''' A KProject defines the directory structure of a project '''
 
@@ -11,25 +12,31 @@ class KProject():
         self._extdir = extdir
         self._k_definitions = OrderedDict()
 
+        # The directories themselves are asked for often; compute them once.
+        # (Through the methods, so that subclasses' layouts are respected.)
+        self._krepodir   = self.extdir('k')
+        self._kbindir    = self.krepodir("k-distribution/target/release/k/bin")
+        self._builddir   = '.build'
+
     def extdir(self, *paths):
         ''' Directory for storing submodules used by KNinja '''
-        return os.path.join(self._extdir, *paths)
+        return _join(self._extdir, *paths)
 
     def krepodir(self, *paths):
         ''' Path to the K Framework '''
-        return self.extdir('k', *paths)
+        return _join(self._krepodir, *paths)
 
     def kbindir(self, *paths):
         ''' Directory where K binaries are stored '''
-        return self.krepodir("k-distribution/target/release/k/bin", *paths)
+        return _join(self._kbindir, *paths)
 
     def kninjadir(self, *paths):
         ''' Path to the KNinja project '''
-        return os.path.join(os.path.dirname(__file__), *paths)
+        return _join(_KNINJA_DIR, *paths)
 
     def builddir(self, *paths):
         ''' The project's main build directory '''
-        return os.path.join('.build', *paths)
+        return _join(self._builddir, *paths)
 
 class KDefinition():
     def __init__( self
@@ -50,6 +57,8 @@ class KDefinition():
         self._krun_flags = krun_flags
         self._kprove_env = kprove_env
         self._kprove_flags = kprove_flags
+        self._krun_flags_tuple = tuple(krun_flags.split())
+        self._kprove_flags_tuple = tuple(kprove_flags.split())
 
         self.proj._k_definitions[alias] = self
         if self._directory == None:
@@ -62,69 +71,109 @@ class KDefinition():
     @property
     def backend(self): return self._backend
     def directory(self, *path):
-        return os.path.join(self._directory, *path)
+        return _join(self._directory, *path)
 
 class KRunner():
     def __init__(self, proj, default_definition = None):
-        self.parser = argparse.ArgumentParser()
+        self._parser = argparse.ArgumentParser()
         self.proj = proj
-        parser = self.parser
+        parser = self._parser
         self.default_definition = default_definition
-
+        self._defn_keys = list(proj._k_definitions) # Keys in the OrderedDict
+        if default_definition is not None and default_definition not in self._defn_keys:
+            raise ValueError('Unknown default definition "%s"' % (default_definition))
+        self._default_defn = default_definition or self._defn_keys[0]
+        self._bin = { 'kast':   proj.kbindir('kast')
+                    , 'krun':   proj.kbindir('krun')
+                    , 'kprove': proj.kbindir('kprove')
+                    }
+
+        # Every command gets its subparser up front, so that usage and error
+        # messages list them all, but their arguments are only added when
+        # needed: a single invocation only uses one of them. See `main` and
+        # `parser`.
         subparsers = parser.add_subparsers()
+        self._pending_arguments = OrderedDict(
+            [ ('kast',  (subparsers.add_parser('kast',  help = 'Run a program against a definition'), self._add_kast_arguments))
+            , ('run',   (subparsers.add_parser('run',   help = 'Run a program against a definition'), self._add_run_arguments))
+            , ('prove', (subparsers.add_parser('prove', help = 'Use KProve to check a specification'), self._add_prove_arguments))
+            ])
 
-        kast_parser = subparsers.add_parser('kast', help = 'Run a program against a definition')
+    def _add_kast_arguments(self, kast_parser):
         self.add_definition_argument(kast_parser)
         kast_parser.add_argument('program', help = 'Path to program')
         kast_parser.add_argument('args', nargs = argparse.REMAINDER, help = 'Arguments to pass to K')
-        kast_parser.set_defaults(func = functools.partial(self.execute_kast, self))
+        kast_parser.set_defaults(func = self.execute_kast)
 
-        run_parser = subparsers.add_parser('run', help = 'Run a program against a definition')
+    def _add_run_arguments(self, run_parser):
         self.add_definition_argument(run_parser)
         run_parser.add_argument('program', help = 'Path to program')
         run_parser.add_argument('args', nargs = argparse.REMAINDER, help = 'Arguments to pass to K')
-        run_parser.set_defaults(func = functools.partial(self.execute_krun, self))
+        run_parser.set_defaults(func = self.execute_krun)
 
-        prove_parser = subparsers.add_parser('prove', help = 'Use KProve to check a specification')
+    def _add_prove_arguments(self, prove_parser):
         self.add_definition_argument(prove_parser)
         prove_parser.add_argument('specification', help = 'Path to spec')
         prove_parser.add_argument('args', nargs = argparse.REMAINDER, help = 'Arguments to pass to K')
-        prove_parser.set_defaults(func = functools.partial(self.execute_kprove, self))
+        prove_parser.set_defaults(func = self.execute_kprove)
+
+    @property
+    def parser(self):
+        ''' The argument parser, with the arguments of every command '''
+        self._add_arguments(list(self._pending_arguments))
+        return self._parser
+
+    def _add_arguments(self, commands):
+        for command in commands:
+            subparser, add_arguments = self._pending_arguments.pop(command, (None, None))
+            if subparser is not None: add_arguments(subparser)
 
     def add_definition_argument(self, subparser):
-        defs = self.proj._k_definitions
         subparser.add_argument( '--definition'
-                              , choices = list(defs) # Keys in the OrderedDict
-                              , default = list(defs)[0]
+                              , choices = self._defn_keys
+                              , default = self._default_defn
                               , help = 'Alias of definition'
                               )
 
     def main(self, argv = sys.argv[1:]):
-        namespace = self.parser.parse_args(argv)
-        namespace.func.func(namespace)
+        # Only the command given needs its arguments. Otherwise (`-h`, an
+        # unknown command and so on) add them all, so argparse can report them.
+        if argv and argv[0] in self._pending_arguments:
+            self._add_arguments([argv[0]])
+        else:
+            self._add_arguments(list(self._pending_arguments))
+        namespace = self._parser.parse_args(argv)
+        namespace.func(namespace)
 
     def execute_kast(self, args):
-        os.execlp( self.proj.kbindir('kast')
-                 , self.proj.kbindir('kast')
-                 , '--directory', self.proj._k_definitions[args.definition].directory()
-                 , args.program
-                 , *args.args
-                 )
+        defn = self.proj._k_definitions[args.definition]
+        directory = defn.directory()
+        binary = self._bin['kast']
+        os.execv( binary
+                , [ binary
+                  , '--directory', directory
+                  , args.program
+                  ] + args.args
+                )
     def execute_krun(self, args):
-        definition = self.proj._k_definitions[args.definition]
-        binary = self.proj.kbindir('krun')
-        os.execlp( binary
-                 , self.proj.kbindir('krun')
-                 , '--directory', definition.directory()
-                 , args.program
-                 , *self.proj._k_definitions[args.definition]._krun_flags.split()
-                 , *args.args
-                 )
+        defn = self.proj._k_definitions[args.definition]
+        directory = defn.directory()
+        binary = self._bin['krun']
+        os.execv( binary
+                , [ binary
+                  , '--directory', directory
+                  , args.program
+                  , *defn._krun_flags_tuple
+                  ] + args.args
+                )
     def execute_kprove(self, args):
-        os.execlp( self.proj.kbindir('kprove')
-                 , self.proj.kbindir('kprove')
-                 , '--directory', self.proj._k_definitions[args.definition].directory()
-                 , args.specification
-                 , *self.proj._k_definitions[args.definition]._kprove_flags.split()
-                 , *args.args
-                 )
+        defn = self.proj._k_definitions[args.definition]
+        directory = defn.directory()
+        binary = self._bin['kprove']
+        os.execv( binary
+                , [ binary
+                  , '--directory', directory
+                  , args.specification
+                  , *defn._kprove_flags_tuple
+                  ] + args.args
+                )